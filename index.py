@@ -1,251 +1,651 @@
-from flask import Flask, request, jsonify
+from quart import Quart, request, jsonify
+from quart.json.provider import JSONProvider
 import os
-import requests
-import uuid
-from flask_cors import CORS
-import json
+import asyncio
+import aiohttp
+import hashlib
+import gzip
+from quart_cors import cors
+import orjson
+import msgspec
+from typing import Annotated, Literal, Optional
 from dotenv import load_dotenv
+from verdict_worker import VerdictWorker
+from negotiation_store import MemoryNegotiationStore, RedisNegotiationStore, is_negotiation_id
 load_dotenv()
 
-app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
+class OrjsonProvider(JSONProvider):
+    """Encode and decode request and response bodies with orjson."""
 
-# OpenRouter API for Mistral
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand the encoded bytes straight to the response without a str round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+# Seconds to wait for in-flight verdicts on shutdown before cancelling them;
+# matches graceful_timeout in hypercorn.toml
+VERDICT_SHUTDOWN_TIMEOUT = int(os.environ.get("VERDICT_SHUTDOWN_TIMEOUT", 150))
+
+app = Quart(__name__)
+app.config["BACKGROUND_TASK_SHUTDOWN_TIMEOUT"] = VERDICT_SHUTDOWN_TIMEOUT
+app.json = OrjsonProvider(app)
+app = cors(app)  # Enable CORS for all routes
+
+# OpenRouter API, serving PRIMARY_MODEL and FALLBACK_MODEL
 OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
 OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
 
+# Maximum number of simultaneous connections held open to OpenRouter
+OPENROUTER_CONNECTION_LIMIT = int(os.environ.get("OPENROUTER_CONNECTION_LIMIT", 256))
+
+# Verdicts come from the faster PRIMARY_MODEL; a reply that cannot be parsed
+# into a verdict is retried once with FALLBACK_MODEL
+PRIMARY_MODEL = os.environ.get("PRIMARY_MODEL", "meta-llama/llama-3.2-3b-instruct:free")
+FALLBACK_MODEL = os.environ.get("FALLBACK_MODEL", "mistralai/mistral-7b-instruct:free")
+
+# Seconds a generation claim lasts without being renewed (a running attempt
+# renews it every third of that, so only a dead worker's claim runs out), and
+# seconds to wait before retrying after a failed attempt
+GENERATION_LEASE = int(os.environ.get("VERDICT_GENERATION_LEASE", 60))
+VERDICT_RETRY_DELAY = int(os.environ.get("VERDICT_RETRY_DELAY", 10))
+
+# Completion tokens allowed per negotiation, so generation stops promptly
+VERDICT_MAX_TOKENS = int(os.environ.get("VERDICT_MAX_TOKENS", 400))
+
+# Responses smaller than this many bytes are sent uncompressed
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 500))
+
+# Verdict batching: negotiations completing within BATCH_WINDOW seconds of each
+# other share one OpenRouter request, up to MAX_BATCH per request
+MAX_BATCH = int(os.environ.get("VERDICT_MAX_BATCH", 8))
+BATCH_WINDOW = float(os.environ.get("VERDICT_BATCH_WINDOW_MS", 100)) / 1000
+
 headers = {
     "Authorization": f"Bearer {OPENROUTER_API_KEY}",
     "Content-Type": "application/json"
 }
 
-# In-memory storage for negotiations
-# Structure: {negotiation_id: {
-#    "messages": [{"speaker": "user1", "message": "..."}, ...],
-#    "user1_count": 0,
-#    "user2_count": 0,
-#    "total_count": 0
-# }}
-negotiations = {}
+# System prompts are module constants so every request sends a byte-identical
+# prefix, which providers can serve from their prompt cache
+SYSTEM_MESSAGE = """\
+You are a fair and impartial legal mediator. Analyze the following negotiation between two parties \
+and provide a balanced verdict that represents a fair compromise. Your response must be in valid JSON \
+format with two fields:
+1. 'summary': A brief summary of the negotiation and the key points of contention
+2. 'compromise': A detailed middle-ground solution that addresses the concerns of both parties, just a paragraph and nothing else, no other objects
+
+Respond only with the JSON object, no additional text or explanation."""
+
+BATCH_SYSTEM_MESSAGE = """\
+You are a fair and impartial legal mediator. You will be given several independent negotiations \
+between two parties, each introduced by a line of the form '=== NEGOTIATION k ==='. Analyze each \
+negotiation on its own and provide a balanced verdict that represents a fair compromise. Your response \
+must be a valid JSON object whose keys are the negotiation numbers as strings ("1", "2", ...) and whose \
+values are objects with two fields:
+1. 'summary': A brief summary of the negotiation and the key points of contention
+2. 'compromise': A detailed middle-ground solution that addresses the concerns of both parties, just a paragraph and nothing else, no other objects
+
+Respond only with the JSON object, no additional text or explanation."""
+
+# Mark the system prompt with cache_control for providers that need explicit
+# prompt caching breakpoints (e.g. Anthropic models on OpenRouter)
+PROMPT_CACHE_CONTROL = os.environ.get("OPENROUTER_PROMPT_CACHE_CONTROL", "").lower() in ("1", "true", "yes")
+
+def system_content(system_message):
+    """Content of the system message, as a cacheable text part when PROMPT_CACHE_CONTROL is set"""
+    if not PROMPT_CACHE_CONTROL:
+        return system_message
+    
+    return [{"type": "text", "text": system_message, "cache_control": {"type": "ephemeral"}}]
+
+# Request pieces that are the same for every verdict, built once
+SYSTEM_MESSAGE_DICT = {"role": "system", "content": system_content(SYSTEM_MESSAGE)}
+BATCH_SYSTEM_MESSAGE_DICT = {"role": "system", "content": system_content(BATCH_SYSTEM_MESSAGE)}
+BASE_PAYLOAD = {
+    "temperature": 0.3,
+    # Ask for strict JSON so the reply can be parsed directly
+    "response_format": {"type": "json_object"},
+    "stream": True
+}
+
+# Storage for negotiations: Redis when REDIS_URL is set (required to run more
+# than one server worker), otherwise process memory
+REDIS_URL = os.environ.get("REDIS_URL")
+store = RedisNegotiationStore(REDIS_URL) if REDIS_URL else MemoryNegotiationStore()
+
+# Verdicts keyed by a hash of the transcript they were generated from
+VERDICT_CACHE_SIZE = int(os.environ.get("VERDICT_CACHE_SIZE", 1024))
+verdict_cache = {}
+
+@app.before_serving
+async def create_session():
+    """Open one long-lived HTTP session so every verdict reuses pooled connections."""
+    app.session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=OPENROUTER_CONNECTION_LIMIT,
+            keepalive_timeout=75,
+            ttl_dns_cache=300
+        ),
+        # Fail fast on an unreachable host, but give the model time to generate
+        timeout=aiohttp.ClientTimeout(total=120, sock_connect=3.05)
+    )
+    verdict_worker.start()
+    verdict_queue.start()
+
+@app.after_serving
+async def close_session():
+    await verdict_queue.stop()
+    await verdict_worker.stop()
+    await app.session.close()
+    await store.close()
+
+@app.after_request
+async def compress_response(response):
+    """Gzip JSON responses of at least COMPRESS_MIN_SIZE bytes for clients that accept it"""
+    if response.mimetype != "application/json" or "Content-Encoding" in response.headers:
+        return response
+    
+    data = await response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    
+    # Caches must keep the plain and the gzipped body apart, so the header goes
+    # on the uncompressed variant too
+    response.vary.add("Accept-Encoding")
+    # Honour explicit refusals such as "gzip;q=0"
+    if request.accept_encodings.quality("gzip") <= 0:
+        return response
+    
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
+class NegotiateRequest(msgspec.Struct):
+    """Body of POST /negotiate, validated while it is decoded"""
+    speaker: Literal["user1", "user2"]
+    message: Annotated[str, msgspec.Meta(min_length=1)]
+    negotiation_id: Optional[str] = None
+
+# Error returned when a speaker tries to exceed their 5-message limit
+LIMIT_ERRORS = {
+    "user1": "User1 has already sent 5 messages",
+    "user2": "User2 has already sent 5 messages"
+}
+
+async def in_progress_response(negotiation_id, counts):
+    """Return the current status of a negotiation that still accepts messages"""
+    return jsonify({
+        "negotiation_id": negotiation_id,
+        "status": "in_progress",
+        "messages_sent": counts["total_count"],
+        "user1_messages": counts["user1_count"],
+        "user2_messages": counts["user2_count"],
+        "messages_remaining": 10 - counts["total_count"]
+    })
+
+async def generating_response(negotiation_id, counts):
+    """
+    Generate the verdict with PRIMARY_MODEL (FALLBACK_MODEL if needed) in the background; the client
+    polls /negotiation/<negotiation_id> until it is ready
+    """
+    await schedule_verdict(negotiation_id)
+    
+    return jsonify({
+        "negotiation_id": negotiation_id,
+        "status": "generating"
+    })
 
 @app.route('/negotiate', methods=['POST'])
-def negotiate():
+async def negotiate():
     try:
-        data = request.json
-        
-        # Validate incoming request
-        if not data or not isinstance(data, dict):
+        # Decode and validate the incoming request in one pass
+        try:
+            data = msgspec.json.decode(await request.get_data(), type=NegotiateRequest)
+        except msgspec.ValidationError as e:
+            return jsonify({"error": str(e)}), 400
+        except msgspec.DecodeError:
             return jsonify({"error": "Invalid request format"}), 400
         
-        # Extract required fields
-        negotiation_id = data.get('negotiation_id')
-        speaker = data.get('speaker')
-        message = data.get('message')
-        
-        # Validate fields
-        if not speaker or not message:
-            return jsonify({"error": "Missing required fields: 'speaker' and 'message' are required"}), 400
-            
-        if speaker not in ['user1', 'user2']:
-            return jsonify({"error": "Speaker must be either 'user1' or 'user2'"}), 400
+        negotiation_id = data.negotiation_id
+        speaker = data.speaker
+        message = data.message
         
-        # Create new negotiation if needed
+        # Create new negotiation if needed; an ID that create could not have
+        # returned is rejected before it reaches a store key
         if not negotiation_id:
-            negotiation_id = str(uuid.uuid4())
-            negotiations[negotiation_id] = {
-                "messages": [],
-                "user1_count": 0,
-                "user2_count": 0,
-                "total_count": 0
-            }
-        elif negotiation_id not in negotiations:
+            negotiation_id = await store.create()
+        elif not is_negotiation_id(negotiation_id):
+            return jsonify({"error": f"Negotiation with ID {negotiation_id} not found"}), 404
+        
+        # Add message to negotiation and update message counts; the limit
+        # check and the update happen atomically in the store
+        result = await store.add_message(negotiation_id, speaker, message)
+        if result is None:
             return jsonify({"error": f"Negotiation with ID {negotiation_id} not found"}), 404
         
         # Check if user has exceeded their 5-message limit
-        if speaker == "user1" and negotiations[negotiation_id]["user1_count"] >= 5:
-            return jsonify({"error": "User1 has already sent 5 messages"}), 400
-        if speaker == "user2" and negotiations[negotiation_id]["user2_count"] >= 5:
-            return jsonify({"error": "User2 has already sent 5 messages"}), 400
-        
-        # Add message to negotiation
-        negotiations[negotiation_id]["messages"].append({
-            "speaker": speaker,
-            "message": message
-        })
-        
-        # Update message counts
-        if speaker == "user1":
-            negotiations[negotiation_id]["user1_count"] += 1
-        else:
-            negotiations[negotiation_id]["user2_count"] += 1
-            
-        negotiations[negotiation_id]["total_count"] += 1
+        accepted, counts = result
+        if not accepted:
+            return jsonify({"error": LIMIT_ERRORS[speaker]}), 400
         
-        # Check if we've reached 10 messages total (5 from each user)
-        if negotiations[negotiation_id]["total_count"] == 10:
-            # Generate verdict using Mistral model
-            verdict = generate_verdict(negotiations[negotiation_id]["messages"])
-            
-            # Clean up the negotiation data (optional)
-            # del negotiations[negotiation_id]
-            
-            return jsonify({
-                "negotiation_id": negotiation_id,
-                "status": "completed",
-                "verdict": verdict
-            })
-        else:
-            # Return current status
-            return jsonify({
-                "negotiation_id": negotiation_id,
-                "status": "in_progress",
-                "messages_sent": negotiations[negotiation_id]["total_count"],
-                "user1_messages": negotiations[negotiation_id]["user1_count"],
-                "user2_messages": negotiations[negotiation_id]["user2_count"],
-                "messages_remaining": 10 - negotiations[negotiation_id]["total_count"]
-            })
+        # The message that brings the total to 10 (5 from each user) starts the verdict
+        respond = generating_response if counts["total_count"] == 10 else in_progress_response
+        return await respond(negotiation_id, counts)
             
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-def generate_verdict(messages):
+async def schedule_verdict(negotiation_id):
+    """Start generating the verdict in the background unless an attempt is already running."""
+    token = await store.claim_generation(negotiation_id, GENERATION_LEASE)
+    if token is not None:
+        app.add_background_task(store_verdict, negotiation_id, token)
+
+async def hold_generation(negotiation_id, token):
+    """Keep renewing a generation claim while its attempt waits on rate limits, retries and the fallback model."""
+    while True:
+        await asyncio.sleep(GENERATION_LEASE / 3)
+        if not await store.renew_generation(negotiation_id, token, GENERATION_LEASE):
+            return
+
+async def store_verdict(negotiation_id, token):
+    """
+    Generate the verdict for a finished negotiation and keep it so it is never regenerated.
+    A failed attempt is only recorded as the negotiation's verdict_error, so a later
+    poll schedules it again after VERDICT_RETRY_DELAY seconds.
+    """
+    retry_after = VERDICT_RETRY_DELAY
+    holder = asyncio.create_task(hold_generation(negotiation_id, token))
+    try:
+        negotiation = await store.get(negotiation_id)
+        if negotiation is None or "verdict" in negotiation:
+            # Evicted or expired before its verdict was started, or an earlier
+            # attempt finished between the claim and this read
+            return
+        
+        verdict, ok = await generate_verdict(negotiation["speakers"], negotiation["texts"])
+        if ok:
+            await store.set_verdict(negotiation_id, verdict)
+            retry_after = 0
+        else:
+            await store.set_verdict_error(negotiation_id, verdict)
+    finally:
+        holder.cancel()
+        await store.release_generation(negotiation_id, token, retry_after)
+
+class PendingVerdictQueue:
+    """
+    Collects verdict requests that arrive close together and resolves them with a
+    single OpenRouter call, so a burst of completed negotiations costs one round-trip.
     """
-    Generate a verdict using Mistral via OpenRouter API based on the negotiation messages.
+
+    def __init__(self, max_batch=MAX_BATCH, window=BATCH_WINDOW):
+        self.max_batch = max_batch
+        self.window = window
+        self.queue = None
+        self.collector = None
+        self.dispatches = set()
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.collector = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        # Dispatches still running belong to verdicts whose background tasks
+        # have already been given up on at shutdown
+        self.collector.cancel()
+        for dispatch in self.dispatches:
+            dispatch.cancel()
+        await asyncio.gather(self.collector, *self.dispatches, return_exceptions=True)
+
+    async def submit(self, conversation_text):
+        """Queue a negotiation transcript and wait for its verdict."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((conversation_text, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+
+            # Keep gathering until the window closes or the batch is full
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # Dispatch in the background so the next batch can start collecting
+            task = asyncio.create_task(self._dispatch(batch))
+            self.dispatches.add(task)
+            task.add_done_callback(self.dispatches.discard)
+
+    async def _dispatch(self, batch):
+        try:
+            if len(batch) == 1:
+                verdicts = [await request_verdict(batch[0][0])]
+            else:
+                verdicts = await request_batch_verdicts([conversation_text for conversation_text, _ in batch])
+            for (_, future), verdict in zip(batch, verdicts):
+                if not future.done():
+                    future.set_result(verdict)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+verdict_worker = VerdictWorker()
+verdict_queue = PendingVerdictQueue()
+
+async def generate_verdict(speakers, texts):
+    """
+    Generate a verdict using PRIMARY_MODEL via OpenRouter API based on the negotiation messages,
+    falling back to FALLBACK_MODEL when its answer can't be parsed.
+    Negotiations completing at the same time are batched into one API call.
     
     Args:
-        messages (list): List of dictionaries containing speaker and message content
+        speakers (list): Speaker of each message, in order
+        texts (list): Content of each message, in order
     
     Returns:
-        dict: Contains summary and compromise suggestion.
+        tuple: (dict with summary and compromise suggestion, whether the verdict was
+            generated successfully rather than describing an error)
     """
-    try:
-        # Format the conversation for the AI
-        conversation_text = "\n".join([f"{msg['speaker']}: {msg['message']}" for msg in messages])
+    conversation_text = format_conversation(speakers, texts)
+    
+    # Identical transcripts get the same verdict without another API call
+    verdict = verdict_cache.get(transcript_key(conversation_text))
+    if verdict is not None:
+        return verdict, True
+    
+    return await verdict_queue.submit(conversation_text)
+
+def format_conversation(speakers, texts):
+    """Format a negotiation transcript for the AI"""
+    # str.join materializes its argument anyway, so a list is faster than a generator here
+    return "\n".join([f"{speaker}: {text}" for speaker, text in zip(speakers, texts)])
+
+def transcript_key(conversation_text):
+    """Cache key identifying a negotiation transcript"""
+    return hashlib.sha256(conversation_text.encode()).hexdigest()
+
+def remember_verdict(conversation_text, verdict):
+    """Cache a successfully generated verdict, evicting the oldest entry when full"""
+    if len(verdict_cache) >= VERDICT_CACHE_SIZE:
+        del verdict_cache[next(iter(verdict_cache))]
+    verdict_cache[transcript_key(conversation_text)] = verdict
+
+def normalize_verdict(verdict):
+    """Ensure a parsed verdict has the required fields in the desired structure"""
+    if not isinstance(verdict, dict) or "summary" not in verdict or "compromise" not in verdict:
+        return None
+    
+    return {
+        "compromise": verdict["compromise"],
+        "summary": verdict["summary"]
+    }
+
+async def call_openrouter(system_message_dict, user_message, model, max_tokens):
+    """
+    Send one chat completion request to OpenRouter.
+    
+    Args:
+        system_message_dict (dict): Prebuilt system message
+        user_message (str): Content of the user message
+        model (str): OpenRouter model ID
+        max_tokens (int): Cap on generated tokens
+    
+    Returns:
+        tuple: (status code, message content on success or error text otherwise)
+    """
+    payload = {
+        **BASE_PAYLOAD,
+        "model": model,
+        "max_tokens": max_tokens,
+        "messages": [system_message_dict, {"role": "user", "content": user_message}]
+    }
+    
+    return await verdict_worker.post(
+        app.session, OPENROUTER_API_URL, headers, payload, read=read_completion_stream
+    )
+
+async def read_completion_stream(response):
+    """Accumulate the content deltas of a streamed (server-sent events) chat completion"""
+    parts = []
+    async for line in response.content:
+        # Skip blank separators and ": OPENROUTER PROCESSING" keep-alive comments
+        if not line.startswith(b"data: "):
+            continue
         
-        # Create system and user messages for the AI
-        system_message = """
-        You are a fair and impartial legal mediator. Analyze the following negotiation between two parties 
-        and provide a balanced verdict that represents a fair compromise. Your response must be in valid JSON 
-        format with two fields:
-        1. 'summary': A brief summary of the negotiation and the key points of contention
-        2. 'compromise': A detailed middle-ground solution that addresses the concerns of both parties, just a paragraph and nothing else, no other objects
+        data = line[6:].strip()
+        if data == b"[DONE]":
+            break
         
-        Respond only with the JSON object, no additional text or explanation.
-        """
+        chunk = orjson.loads(data)
+        if "error" in chunk:
+            raise RuntimeError(f"OpenRouter stream error: {chunk['error'].get('message', chunk['error'])}")
         
+        content = chunk["choices"][0]["delta"].get("content")
+        if content:
+            parts.append(content)
+    
+    return "".join(parts)
+
+async def request_verdict(conversation_text, model=PRIMARY_MODEL):
+    """
+    Generate the verdict for a single negotiation transcript, retrying with
+    FALLBACK_MODEL if the reply cannot be parsed into a verdict.
+    
+    Returns:
+        tuple: (verdict dict, whether it was generated successfully)
+    """
+    try:
+        # Create the user message for the AI
         user_message = f"Here is the negotiation conversation:\n\n{conversation_text}"
         
-        # Prepare the request payload
-        payload = {
-            "model": "mistralai/mistral-7b-instruct:free",
-            "messages": [
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ], 
-            "temperature": 0.3
-        }
-        
-        # Make the API request
-        response = requests.post(OPENROUTER_API_URL, headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            response_data = response.json()
-            response_content = response_data["choices"][0]["message"]["content"]
+        status, content = await call_openrouter(SYSTEM_MESSAGE_DICT, user_message, model, VERDICT_MAX_TOKENS)
+        
+        if status == 200:
+            # Clean up the response to extract just the JSON part
+            verdict = normalize_verdict(extract_json(content))
+            if verdict is None and model != FALLBACK_MODEL:
+                return await request_verdict(conversation_text, FALLBACK_MODEL)
             
-            # Parse the JSON response
-            try:
-                # Clean up the response to extract just the JSON part
-                json_text = extract_json(response_content)
-                verdict = json.loads(json_text) if isinstance(json_text, str) else json_text
-                
-                # Ensure response has required fields
-                if "summary" not in verdict or "compromise" not in verdict:
-                    verdict = {
-                        "summary": "Failed to generate proper verdict format.",
-                        "compromise": "Please try again with clearer negotiation points."
-                    }
-                
-                # Adjust the verdict format to the desired structure
-                return {
-                    "compromise": verdict.get("compromise", "Compromise here"),
-                    "summary": verdict.get("summary", "Summary here")
-                }
-                
-            except json.JSONDecodeError:
-                # Handle case where AI doesn't return valid JSON
+            if verdict is None:
+                # Handle case where AI doesn't return a valid verdict
                 return {
                     "compromise": "The negotiation was processed, but a structured verdict could not be generated. Please try again.",
                     "summary": "Error parsing AI response."
-                }
+                }, False
+            
+            remember_verdict(conversation_text, verdict)
+            return verdict, True
         else:
             return {
                 "summary": "API request failed.",
-                "compromise": f"Status code: {response.status_code}. Error: {response.text}"
-            }
+                "compromise": f"Status code: {status}. Error: {content}"
+            }, False
             
     except Exception as e:
         print(f"Error generating verdict: {str(e)}")
         return {
             "compromise": f"An error occurred: {str(e)}",
             "summary": "Error generating verdict."
-        }
+        }, False
 
-def extract_json(text):
-    """Extract JSON content from the LLM response"""
+async def request_batch_verdicts(batch):
+    """
+    Generate verdicts for several negotiations with one API call.
+    
+    Args:
+        batch (list): One transcript per negotiation
+    
+    Returns:
+        list: One (verdict dict, whether it was generated successfully) tuple per
+            negotiation, in the same order as the batch.
+    """
     try:
-        import re
-        import ast
+        sections = [
+            f"=== NEGOTIATION {k} ===\n{conversation_text}"
+            for k, conversation_text in enumerate(batch, start=1)
+        ]
+        user_message = "Here are the negotiation conversations:\n\n" + "\n\n".join(sections)
+        
+        status, content = await call_openrouter(
+            BATCH_SYSTEM_MESSAGE_DICT, user_message, PRIMARY_MODEL, VERDICT_MAX_TOKENS * len(batch)
+        )
+        
+        if status != 200:
+            return [({
+                "summary": "API request failed.",
+                "compromise": f"Status code: {status}. Error: {content}"
+            }, False) for _ in batch]
         
-        # Remove markdown code block indicators if present
-        text = re.sub(r"```(?:json)?", "", text).strip()
+        verdicts = extract_json(content)
+        if not isinstance(verdicts, dict):
+            verdicts = {}
         
-        # Try to find JSON content between curly braces
-        match = re.search(r"\{.*\}", text, re.DOTALL)
-        if match:
-            cleaned = match.group().replace('\n', ' ').replace('\r', '')
-            return json.loads(cleaned)
+        results = []
+        for k, conversation_text in enumerate(batch, start=1):
+            verdict = normalize_verdict(verdicts.get(str(k)))
+            if verdict is not None:
+                remember_verdict(conversation_text, verdict)
+            results.append(verdict)
         
-        # As a fallback, try literal evaluation
-        return ast.literal_eval(text)
+        # Negotiations missing from the reply are retried one by one with the fallback model
+        retries = [
+            request_verdict(conversation_text, FALLBACK_MODEL)
+            for conversation_text, verdict in zip(batch, results) if verdict is None
+        ]
+        retried = iter(await asyncio.gather(*retries))
+        return [(verdict, True) if verdict is not None else next(retried) for verdict in results]
+            
     except Exception as e:
+        print(f"Error generating batch verdicts: {str(e)}")
+        return [({
+            "compromise": f"An error occurred: {str(e)}",
+            "summary": "Error generating verdict."
+        }, False) for _ in batch]
+
+def extract_json(text):
+    """Parse the JSON object in the LLM response, or return None if there is none"""
+    # Some models still wrap the object in a markdown code block
+    text = text.strip().removeprefix("```json").removeprefix("```").removesuffix("```")
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    
+    # Models that ignore response_format may surround the object with prose
+    span = find_json_object(text)
+    try:
+        return orjson.loads(span) if span is not None else None
+    except orjson.JSONDecodeError as e:
         print("JSON parsing error:", e)
-        return {
-            "summary": "Error parsing response.",
-            "compromise": "Could not extract valid JSON from the model response."
-        }
+        return None
+
+def find_json_object(text):
+    """
+    Return the first balanced {...} span in text, or None.
+    
+    Single pass that tracks brace depth and skips braces inside JSON strings,
+    stopping at the brace that closes the first object.
+    """
+    start = text.find("{")
+    if start == -1:
+        return None
+    
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
 
 @app.route('/negotiation/<negotiation_id>', methods=['GET'])
-def get_negotiation(negotiation_id):
+async def get_negotiation(negotiation_id):
     """
     Get the current status of a negotiation by ID, including the verdict if completed.
+    While the verdict is still being generated the status is "generating", along with
+    the error of the last failed attempt if there was one.
     """
-    if negotiation_id not in negotiations:
+    if not is_negotiation_id(negotiation_id):
         return jsonify({"error": "Negotiation not found"}), 404
-
-    negotiation = negotiations[negotiation_id]
+    
+    negotiation = await store.get(negotiation_id)
+    if negotiation is None:
+        return jsonify({"error": "Negotiation not found"}), 404
+    
+    if negotiation["total_count"] < 10:
+        status = "in_progress"
+    elif "verdict" in negotiation:
+        status = "completed"
+    else:
+        # Restart generation if no attempt is running, e.g. after a failure or
+        # a server restart that cancelled the background task
+        await schedule_verdict(negotiation_id)
+        status = "generating"
     
     response_data = {
         "negotiation_id": negotiation_id,
-        "status": "in_progress" if negotiation["total_count"] < 10 else "completed",
+        "status": status,
         "messages_sent": negotiation["total_count"],
         "user1_messages": negotiation["user1_count"],
         "user2_messages": negotiation["user2_count"],
         "messages_remaining": max(0, 10 - negotiation["total_count"]),
-        "messages": negotiation["messages"]
+        "messages": [
+            {"speaker": speaker, "message": text}
+            for speaker, text in zip(negotiation["speakers"], negotiation["texts"])
+        ]
     }
 
-    # If negotiation is completed, generate and include the verdict
-    if negotiation["total_count"] == 10:
-        verdict = generate_verdict(negotiation["messages"])
-        response_data["verdict"] = verdict
+    # If negotiation is completed, include the stored verdict
+    if status == "completed":
+        response_data["verdict"] = negotiation["verdict"]
+    elif status == "generating" and "verdict_error" in negotiation:
+        response_data["verdict_error"] = negotiation["verdict_error"]
 
     return jsonify(response_data)
 
 if __name__ == '__main__':
+    import uvloop
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+    
     # Check if OpenRouter API key is set
     if not os.environ.get("OPENROUTER_API_KEY"):
         print("Warning: OPENROUTER_API_KEY environment variable is not set!")
         print("Set it before running the application: export OPENROUTER_API_KEY='your-api-key'")
     
-    port = int(os.environ.get("PORT", 5500))
-    app.run(host='0.0.0.0', port=port, debug=True)
+    # Single-process server on uvloop; for multiple workers run
+    #   hypercorn --config hypercorn.toml index:app
+    config = Config.from_toml(os.path.join(os.path.dirname(os.path.abspath(__file__)), "hypercorn.toml"))
+    config.bind = [f"0.0.0.0:{int(os.environ.get('PORT', 5500))}"]
+    config.workers = 1
+    uvloop.run(serve(app, config))
@@ -0,0 +1,338 @@
+"""
+Storage backends for negotiation state.
+
+MemoryNegotiationStore keeps everything in a process-local dict and is only
+correct with a single server worker. RedisNegotiationStore keeps the state in
+Redis so any number of workers can serve the same negotiation.
+"""
+import os
+import time
+import uuid
+from collections import OrderedDict
+import orjson
+import redis.asyncio as redis
+
+# Seconds a negotiation is kept in Redis after it was created
+NEGOTIATION_TTL = int(os.environ.get("NEGOTIATION_TTL", 86400))
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 64))
+
+# Negotiations kept in process memory before the least recently used is evicted
+MAX_NEGOTIATIONS = int(os.environ.get("MAX_NEGOTIATIONS", 10000))
+
+# Messages each user may send in one negotiation
+MESSAGES_PER_USER = 5
+
+# Counter field for each valid speaker
+COUNT_KEY = {"user1": "user1_count", "user2": "user2_count"}
+
+# Checks the speaker's limit and records the message in one atomic step.
+# KEYS: negotiation hash, speakers list, texts list
+# ARGV: speaker count field, limit, speaker, message text
+# Returns nil if the negotiation does not exist, otherwise
+# {accepted, user1_count, user2_count, total_count}
+ADD_MESSAGE_SCRIPT = """
+local count = redis.call('HGET', KEYS[1], ARGV[1])
+if not count then
+    return false
+end
+
+local accepted = 0
+if tonumber(count) < tonumber(ARGV[2]) then
+    local ttl = redis.call('PTTL', KEYS[1])
+    redis.call('RPUSH', KEYS[2], ARGV[3])
+    redis.call('RPUSH', KEYS[3], ARGV[4])
+    redis.call('PEXPIRE', KEYS[2], ttl)
+    redis.call('PEXPIRE', KEYS[3], ttl)
+    redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+    redis.call('HINCRBY', KEYS[1], 'total_count', 1)
+    accepted = 1
+end
+
+local counts = redis.call('HMGET', KEYS[1], 'user1_count', 'user2_count', 'total_count')
+return {accepted, tonumber(counts[1]), tonumber(counts[2]), tonumber(counts[3])}
+"""
+
+# Sets a field on a negotiation hash only while the negotiation exists, so a
+# verdict finishing after expiry cannot recreate the hash without a TTL.
+# KEYS: negotiation hash
+# ARGV: field to set, encoded value, field to delete
+SET_VERDICT_FIELD_SCRIPT = """
+-- Missing negotiations stay missing, and a stored verdict is final
+if redis.call('EXISTS', KEYS[1]) == 0 or redis.call('HEXISTS', KEYS[1], 'verdict') == 1 then
+    return 0
+end
+
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('HDEL', KEYS[1], ARGV[3])
+end
+return 1
+"""
+
+# KEYS: generation claim key
+# ARGV: owner token, seconds to keep the claim (0 releases it)
+# Only the attempt that took the claim may extend or release it
+UPDATE_GENERATION_CLAIM_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+else
+    redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+
+def is_negotiation_id(value):
+    """Whether value has the form of an ID returned by create; anything else can't name a negotiation."""
+    try:
+        return str(uuid.UUID(value)) == value
+    except (TypeError, ValueError):
+        return False
+
+class MemoryNegotiationStore:
+    """Negotiations held in process memory, evicting the least recently used beyond MAX_NEGOTIATIONS."""
+
+    def __init__(self, max_negotiations=MAX_NEGOTIATIONS):
+        # Messages are kept as two parallel lists rather than a list of dicts
+        # Structure: {negotiation_id: {
+        #    "speakers": ["user1", ...],
+        #    "texts": ["...", ...],
+        #    "user1_count": 0,
+        #    "user2_count": 0,
+        #    "total_count": 0,
+        #    "verdict": {...},  (set once a verdict has been generated successfully)
+        #    "verdict_error": {...}  (set when the last attempt failed)
+        # }}
+        # Ordered from least to most recently used
+        self.negotiations = OrderedDict()
+        self.max_negotiations = max_negotiations
+        # {negotiation_id: (monotonic time until which verdict generation is claimed, owner token)}
+        self.generation_leases = {}
+
+    def _touch(self, negotiation_id):
+        """Return the negotiation, marking it most recently used, or None if it does not exist."""
+        negotiation = self.negotiations.get(negotiation_id)
+        if negotiation is not None:
+            self.negotiations.move_to_end(negotiation_id)
+        return negotiation
+
+    async def create(self):
+        """Start a new negotiation and return its ID."""
+        negotiation_id = str(uuid.uuid4())
+        self.negotiations[negotiation_id] = {
+            "speakers": [],
+            "texts": [],
+            "user1_count": 0,
+            "user2_count": 0,
+            "total_count": 0
+        }
+        while len(self.negotiations) > self.max_negotiations:
+            evicted_id, _ = self.negotiations.popitem(last=False)
+            self.generation_leases.pop(evicted_id, None)
+        return negotiation_id
+
+    async def get(self, negotiation_id):
+        """Return the full negotiation, or None if it does not exist."""
+        return self._touch(negotiation_id)
+
+    async def add_message(self, negotiation_id, speaker, message):
+        """
+        Append a message unless the speaker has reached their limit.
+        
+        Returns:
+            tuple: (whether the message was accepted, message counts),
+                or None if the negotiation does not exist
+        """
+        # Nothing below awaits, so the check and update cannot interleave with
+        # another request on the event loop and no lock is needed
+        negotiation = self._touch(negotiation_id)
+        if negotiation is None:
+            return None
+        
+        count_key = COUNT_KEY[speaker]
+        if negotiation[count_key] >= MESSAGES_PER_USER:
+            return False, negotiation
+        
+        negotiation["speakers"].append(speaker)
+        negotiation["texts"].append(message)
+        
+        # Update message counts
+        negotiation[count_key] += 1
+        negotiation["total_count"] += 1
+        return True, negotiation
+
+    async def set_verdict(self, negotiation_id, verdict):
+        """Store the verdict of a finished negotiation, unless it has been evicted or already has one."""
+        negotiation = self.negotiations.get(negotiation_id)
+        if negotiation is not None and "verdict" not in negotiation:
+            negotiation["verdict"] = verdict
+            negotiation.pop("verdict_error", None)
+
+    async def set_verdict_error(self, negotiation_id, error):
+        """Record the error of a failed verdict attempt, unless the negotiation has been evicted or has a verdict."""
+        negotiation = self.negotiations.get(negotiation_id)
+        if negotiation is not None and "verdict" not in negotiation:
+            negotiation["verdict_error"] = error
+
+    async def claim_generation(self, negotiation_id, lease):
+        """Claim verdict generation for lease seconds; the owner token, or None if an attempt already holds it."""
+        now = time.monotonic()
+        expires, _ = self.generation_leases.get(negotiation_id, (0, None))
+        if expires > now:
+            return None
+        token = uuid.uuid4().hex
+        self.generation_leases[negotiation_id] = (now + lease, token)
+        return token
+
+    def _owns_generation(self, negotiation_id, token):
+        lease = self.generation_leases.get(negotiation_id)
+        return lease is not None and lease[1] == token
+
+    async def renew_generation(self, negotiation_id, token, lease):
+        """Extend a generation claim by lease seconds; False if token no longer holds it."""
+        if not self._owns_generation(negotiation_id, token) or negotiation_id not in self.negotiations:
+            return False
+        self.generation_leases[negotiation_id] = (time.monotonic() + lease, token)
+        return True
+
+    async def release_generation(self, negotiation_id, token, retry_after=0):
+        """Release a generation claim held by token, optionally holding it retry_after more seconds."""
+        if not self._owns_generation(negotiation_id, token):
+            return
+        if retry_after and negotiation_id in self.negotiations:
+            self.generation_leases[negotiation_id] = (time.monotonic() + retry_after, token)
+        else:
+            self.generation_leases.pop(negotiation_id, None)
+
+    async def close(self):
+        pass
+
+class RedisNegotiationStore:
+    """
+    Negotiations held in Redis, shared by every server worker.
+    
+    Each negotiation is a hash "negotiation:<id>" holding the counters and the
+    JSON-encoded verdict, plus parallel lists "negotiation:<id>:speakers" and
+    "negotiation:<id>:texts" of the messages. All expire NEGOTIATION_TTL
+    seconds after creation.
+    """
+
+    def __init__(self, url):
+        self.redis = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+            url,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            decode_responses=True
+        ))
+        self.add_message_script = self.redis.register_script(ADD_MESSAGE_SCRIPT)
+        self.set_verdict_field_script = self.redis.register_script(SET_VERDICT_FIELD_SCRIPT)
+        self.update_generation_claim_script = self.redis.register_script(UPDATE_GENERATION_CLAIM_SCRIPT)
+
+    @staticmethod
+    def _key(negotiation_id):
+        return f"negotiation:{negotiation_id}"
+
+    async def create(self):
+        """Start a new negotiation and return its ID."""
+        negotiation_id = str(uuid.uuid4())
+        key = self._key(negotiation_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={"user1_count": 0, "user2_count": 0, "total_count": 0})
+            pipe.expire(key, NEGOTIATION_TTL)
+            await pipe.execute()
+        return negotiation_id
+
+    async def get(self, negotiation_id):
+        """Return the full negotiation, or None if it does not exist."""
+        key = self._key(negotiation_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(key)
+            pipe.lrange(f"{key}:speakers", 0, -1)
+            pipe.lrange(f"{key}:texts", 0, -1)
+            fields, speakers, texts = await pipe.execute()
+        
+        # A hash without counters is not a negotiation (e.g. a leftover written after expiry)
+        if "total_count" not in fields:
+            return None
+        
+        negotiation = {
+            "speakers": speakers,
+            "texts": texts,
+            "user1_count": int(fields["user1_count"]),
+            "user2_count": int(fields["user2_count"]),
+            "total_count": int(fields["total_count"])
+        }
+        if "verdict" in fields:
+            negotiation["verdict"] = orjson.loads(fields["verdict"])
+        if "verdict_error" in fields:
+            negotiation["verdict_error"] = orjson.loads(fields["verdict_error"])
+        return negotiation
+
+    async def add_message(self, negotiation_id, speaker, message):
+        """
+        Append a message unless the speaker has reached their limit.
+        
+        The check and update run as one Lua script, so concurrent requests on
+        any worker cannot both slip past the limit.
+        
+        Returns:
+            tuple: (whether the message was accepted, message counts),
+                or None if the negotiation does not exist
+        """
+        key = self._key(negotiation_id)
+        result = await self.add_message_script(
+            keys=[key, f"{key}:speakers", f"{key}:texts"],
+            args=[COUNT_KEY[speaker], MESSAGES_PER_USER, speaker, message]
+        )
+        if result is None:
+            return None
+        
+        accepted, user1_count, user2_count, total_count = result
+        return bool(accepted), {
+            "user1_count": user1_count,
+            "user2_count": user2_count,
+            "total_count": total_count
+        }
+
+    async def set_verdict(self, negotiation_id, verdict):
+        """Store the verdict of a finished negotiation, unless it has expired or already has one."""
+        await self.set_verdict_field_script(
+            keys=[self._key(negotiation_id)],
+            args=["verdict", orjson.dumps(verdict), "verdict_error"]
+        )
+
+    async def set_verdict_error(self, negotiation_id, error):
+        """Record the error of a failed verdict attempt, unless the negotiation has expired or has a verdict."""
+        await self.set_verdict_field_script(
+            keys=[self._key(negotiation_id)],
+            args=["verdict_error", orjson.dumps(error), ""]
+        )
+
+    async def claim_generation(self, negotiation_id, lease):
+        """
+        Claim verdict generation for lease seconds; the owner token, or None if an
+        attempt on any worker already holds it. The claim expires on its own if
+        that worker dies.
+        """
+        token = uuid.uuid4().hex
+        claimed = await self.redis.set(f"{self._key(negotiation_id)}:generating", token, nx=True, ex=lease)
+        return token if claimed else None
+
+    async def renew_generation(self, negotiation_id, token, lease):
+        """Extend a generation claim by lease seconds; False if token no longer holds it."""
+        return bool(await self.update_generation_claim_script(
+            keys=[f"{self._key(negotiation_id)}:generating"],
+            args=[token, lease]
+        ))
+
+    async def release_generation(self, negotiation_id, token, retry_after=0):
+        """Release a generation claim held by token, optionally holding it retry_after more seconds."""
+        await self.update_generation_claim_script(
+            keys=[f"{self._key(negotiation_id)}:generating"],
+            args=[token, retry_after]
+        )
+
+    async def close(self):
+        await self.redis.aclose()
@@ -0,0 +1,122 @@
+"""
+Rate-limited, retrying dispatcher for OpenRouter chat completion requests.
+
+Requests are bounded by a concurrency limit plus requests-per-minute and
+tokens-per-minute buckets that refill once a second, and transient failures
+(connection errors, 429 and 5xx responses) are retried with exponential backoff.
+
+The buckets live in each server process. OPENROUTER_MAX_REQUESTS_PER_MINUTE and
+OPENROUTER_MAX_TOKENS_PER_MINUTE are the limits for the whole deployment and are
+divided evenly between SERVER_WORKERS processes, so SERVER_WORKERS must match the
+number of workers the server runs (see hypercorn.toml).
+"""
+import asyncio
+import os
+import random
+import aiohttp
+import orjson
+
+# Server processes sharing the OpenRouter rate limits
+SERVER_WORKERS = max(1, int(os.environ.get("SERVER_WORKERS", 1)))
+
+MAX_CONCURRENT = int(os.environ.get("OPENROUTER_MAX_CONCURRENT", 32))
+MAX_REQUESTS_PER_MINUTE = float(os.environ.get("OPENROUTER_MAX_REQUESTS_PER_MINUTE", 20)) / SERVER_WORKERS
+MAX_TOKENS_PER_MINUTE = float(os.environ.get("OPENROUTER_MAX_TOKENS_PER_MINUTE", 100000)) / SERVER_WORKERS
+MAX_ATTEMPTS = int(os.environ.get("OPENROUTER_MAX_ATTEMPTS", 5))
+
+# Tokens assumed for the completion when the payload does not cap max_tokens
+DEFAULT_COMPLETION_TOKENS = 500
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+def estimate_tokens(payload):
+    """Roughly estimate the tokens a chat completion request will consume (~4 characters per token)"""
+    prompt_chars = sum(len(str(message["content"])) for message in payload["messages"])
+    return prompt_chars // 4 + payload.get("max_tokens", DEFAULT_COMPLETION_TOKENS)
+
+class VerdictWorker:
+    """Throttles and retries OpenRouter requests so bursts stay under the provider's limits."""
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_requests_per_minute=MAX_REQUESTS_PER_MINUTE,
+                 max_tokens_per_minute=MAX_TOKENS_PER_MINUTE, max_attempts=MAX_ATTEMPTS):
+        self.max_concurrent = max_concurrent
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.max_attempts = max_attempts
+        # Room for at least one request, even when this worker's share of the
+        # limit is below one request per minute
+        self.request_capacity = max(1, max_requests_per_minute)
+        self.available_requests = self.request_capacity
+        self.available_tokens = max_tokens_per_minute
+        self.semaphore = None
+        self.refilled = None
+        self.ticker = None
+
+    def start(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        self.refilled = asyncio.Event()
+        self.ticker = asyncio.create_task(self._refill())
+
+    async def stop(self):
+        self.ticker.cancel()
+        try:
+            await self.ticker
+        except asyncio.CancelledError:
+            pass
+
+    async def _refill(self):
+        while True:
+            await asyncio.sleep(1)
+            self.available_requests = min(
+                self.request_capacity,
+                self.available_requests + self.max_requests_per_minute / 60
+            )
+            self.available_tokens = min(
+                self.max_tokens_per_minute,
+                self.available_tokens + self.max_tokens_per_minute / 60
+            )
+            self.refilled.set()
+
+    async def _acquire(self, tokens):
+        # A request larger than the whole bucket would otherwise never be sent
+        tokens = min(tokens, self.max_tokens_per_minute)
+        while self.available_requests < 1 or self.available_tokens < tokens:
+            self.refilled.clear()
+            await self.refilled.wait()
+        self.available_requests -= 1
+        self.available_tokens -= tokens
+
+    async def post(self, session, url, headers, payload, read=None):
+        """
+        Send a chat completion request, waiting for rate-limit capacity and retrying transient failures.
+        
+        Args:
+            read: Optional coroutine function that consumes a successful response;
+                by default the body is parsed as JSON
+        
+        Returns:
+            tuple: (status code, result of read on success or error text otherwise)
+        """
+        tokens = estimate_tokens(payload)
+        # Encode once for every attempt; the Content-Type header is supplied by the caller
+        body = orjson.dumps(payload)
+        
+        for attempt in range(self.max_attempts):
+            await self._acquire(tokens)
+            try:
+                async with self.semaphore:
+                    async with session.post(url, headers=headers, data=body) as response:
+                        if response.status == 200:
+                            if read is not None:
+                                return 200, await read(response)
+                            return 200, await response.json(loads=orjson.loads)
+                        status, error = response.status, await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt + 1 == self.max_attempts:
+                    raise
+            else:
+                if status not in RETRYABLE_STATUSES or attempt + 1 == self.max_attempts:
+                    return status, error
+            
+            # Back off without holding a concurrency slot so other negotiations proceed
+            await asyncio.sleep(2 ** attempt + random.random())